@@ -1,14 +1,21 @@
 # Import required libraries
 import gradio as gr
 from pymilvus import MilvusClient
+import httpx
 import numpy as np
 import arxiv
 import re
-from functools import cache
-from sentence_transformers import SentenceTransformer
-import torch
+import os
+import hashlib
+import time
+import random
+import queue
+import threading
+from concurrent.futures import Future
+from functools import lru_cache, wraps
 from mixedbread_ai.client import MixedbreadAI
 from dotenv import dotenv_values
+from diskcache import Cache
 
 
 ################################################################################
@@ -17,26 +24,97 @@ from dotenv import dotenv_values
 # Set to True if you want to use local recources (cpu/gpu) or False if you want to use MixedBread.ai
 LOCAL = False
 
+# Backend for the local model: "torch", or "onnx" for the int8 quantized model on ONNX Runtime (faster on cpu)
+LOCAL_BACKEND = "torch"
+
 # Set to True if you want to use the fp32 embbedings or False if you want to use the binary embbedings
 FLOAT = False
 
+# Set to True to rescore binary search results with the float query embedding, only used when FLOAT is False
+# Searches RESCORE_OVERSAMPLE times more candidates than requested, then keeps the best ones
+RESCORE = True
+RESCORE_OVERSAMPLE = 4
+
+# Embed queries as float vectors, also needed to rescore binary search results
+EMBED_FLOAT = FLOAT or RESCORE
+
+# Dimension of the mxbai-embed-large-v1 embeddings
+EMBED_DIM = 1024
+
+# Max. number of results a single search may return
+MAX_LIMIT = 25
+
+# Max. number of characters to embed, the model truncates longer inputs anyway
+MAX_INPUT_CHARS = 8000
+
+# Min. HNSW search beam width for float vectors, widened for larger limits
+HNSW_EF = 64
+
+# Number of searches the server handles concurrently, and how many may wait in the queue
+CONCURRENCY_LIMIT = 8
+MAX_QUEUE_SIZE = 64
+
+# Number of clusters to scan when searching the BIN_IVF_FLAT index of binary vectors
+BIN_IVF_NPROBE = 16
+
+# File with whitespace separated arXiv IDs whose vectors are prefetched at startup
+POPULAR_IDS_FILE = "popular_ids.txt"
+
+# Max. seconds to wait for the collection to load at startup, queries search anyway afterwards
+COLLECTION_LOAD_TIMEOUT = 60
+
+# Directory to persist arXiv metadata and embeddings across restarts
+CACHE_DIR = "cache"
+
+# Max. size of the on-disk embedding cache in bytes
+EMBED_CACHE_SIZE = 2**30
+
+# Keep arXiv metadata for a day, the listing is only updated once daily
+ARXIV_CACHE_EXPIRY = 24 * 60 * 60
+
 # Define Milvus client
 milvus_client = MilvusClient("http://localhost:19530")
 
 # Construct the Arxiv API client.
 arxiv_client = arxiv.Client(page_size=1, delay_seconds=1)
 
+# On-disk caches, shared between workers and kept across restarts
+arxiv_cache = Cache(f"{CACHE_DIR}/arxiv")
+
+# Float and binary embeddings are not interchangeable, so keep them apart
+# Bounded on disk, the least recently used embeddings are evicted first
+embed_cache = Cache(f"{CACHE_DIR}/embed_{'float' if EMBED_FLOAT else 'binary'}", size_limit=EMBED_CACHE_SIZE, eviction_policy="least-recently-used")
+
 # Load Model
 # Model to use for embedding
 model_name = "mixedbread-ai/mxbai-embed-large-v1"
 
 if LOCAL:
-    # Make the app device agnostic
-    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    # Import the heavy model dependencies only when running the model locally
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    if LOCAL_BACKEND == "onnx":
+
+        # The quantized ONNX model runs on the cpu with ONNX Runtime
+        device = torch.device("cpu")
+
+        # Load the int8 quantized ONNX export shipped with the model
+        print(f"Loading int8 ONNX model {model_name} to device: {device}")
+        model = SentenceTransformer(model_name, backend="onnx", model_kwargs={"file_name": "onnx/model_quantized.onnx"})
+
+    else:
+
+        # Make the app device agnostic
+        device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
 
-    # Load a pretrained Sentence Transformer model and move it to the appropriate device
-    print(f"Loading model {model_name} to device: {device}")
-    model = SentenceTransformer(model_name).to(device)
+        # Use half precision on gpu, it is about twice as fast and keeps the embeddings' signs
+        dtype = torch.float16 if device.type == "cuda" else torch.float32
+
+        # Load a pretrained Sentence Transformer model and move it to the appropriate device
+        print(f"Loading model {model_name} to device: {device} ({dtype})")
+        model = SentenceTransformer(model_name, model_kwargs={"torch_dtype": dtype}).to(device)
+        model.eval()
 
 else:
     # Import secrets
@@ -47,27 +125,108 @@ else:
     mxbai = MixedbreadAI(api_key=mxbai_api_key)
 
 ################################################################################
+# Function to check if a failed MixedBread.ai API call is worth retrying
+def is_retryable(error):
+
+    # Timeouts and dropped connections, from the API client or the standard library
+    if isinstance(error, (httpx.TransportError, TimeoutError, ConnectionError)):
+        return True
+
+    # Rate limits and server errors of the MixedBread.ai API
+    status_code = getattr(error, "status_code", None)
+    if isinstance(status_code, int):
+        return status_code == 429 or status_code >= 500
+
+    # Anything else is a bug or a local failure, retrying won't help
+    return False
+
+# Decorator to retry remote calls with exponential backoff and full jitter
+def retry_with_backoff(max_attempts=4, initial_delay=1, max_delay=16):
+
+    def decorator(fn):
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+
+            for attempt in range(max_attempts):
+
+                try:
+                    return fn(*args, **kwargs)
+
+                except Exception as e:
+
+                    # Give up on the last attempt or on errors that won't go away
+                    if attempt == max_attempts - 1 or not is_retryable(e):
+                        raise
+
+                    # Sleep a random time up to the exponential backoff, so clients don't retry in lockstep
+                    time.sleep(random.uniform(0, min(max_delay, initial_delay * 2**attempt)))
+
+        return wrapper
+
+    return decorator
+
+# Decorator to share one run between concurrent callers with the same arguments
+def coalesce(fn):
+
+    # Futures of the runs in flight, keyed by arguments
+    inflight = {}
+    lock = threading.Lock()
+
+    @wraps(fn)
+    def wrapper(*args):
+
+        # Join a run in flight, or start a new one
+        with lock:
+            future = inflight.get(args)
+            leader = future is None
+            if leader:
+                future = inflight[args] = Future()
+
+        # Wait for the run started by another caller
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn(*args)
+            future.set_result(result)
+            return result
+
+        except Exception as e:
+            future.set_exception(e)
+            raise
+
+        finally:
+            # Later callers start a fresh run, possibly served from the caches
+            with lock:
+                del inflight[args]
+
+    return wrapper
+
+################################################################################
+# Regex for pre-2007 and post-2007 arXiv IDs, as one alternation so the text is scanned once
+arxiv_id_pattern = re.compile(r"(?:^|\s|\/|arXiv:)(?:(?P<pre>[a-z-]+(?:\.[A-Z]{2})?\/\d{2}(?:0[1-9]|1[012])\d{3})|(?P<post>\d{4}\.\d{4,5}))(?:v\d+)?(?=$|\s)", re.IGNORECASE|re.MULTILINE)
+
 # Function to extract arXiv ID from a given text
 def extract_arxiv_id(text):
 
-    # Define regex patterns for pre-2007 and post-2007 arXiv IDs
-    pre_2007_pattern = re.compile(r"(?:^|\s|\/|arXiv:)([a-z-]+(?:\.[A-Z]{2})?\/\d{2}(?:0[1-9]|1[012])\d{3})(?:v\d+)?(?=$|\s)", re.IGNORECASE|re.MULTILINE)
-    post_2007_pattern = re.compile(r"(?:^|\s|\/|arXiv:)(\d{4}\.\d{4,5})(?:v\d+)?(?=$|\s)", re.IGNORECASE|re.MULTILINE)
-
-    # Search for matches
-    pre_match = pre_2007_pattern.search(text)
-    post_match = post_2007_pattern.search(text)
+    # Every ID contains a "/" (pre-2007) or a "." (post-2007), skip the regex for text without either
+    if "/" not in text and "." not in text:
+        return None
 
-    # Combine the matches
-    match = pre_match or post_match
+    # Search for the first ID of either format
+    match = arxiv_id_pattern.search(text)
 
     # Return the match if found, otherwise return None
-    return match.group(1) if match else None
+    return (match.group("pre") or match.group("post")) if match else None
 
 ################################################################################            
 
 # Function to search ArXiv by ID
-@cache
+# Concurrent lookups of the same ID share one request to arXiv
+# Only cached on disk, so entries expire after ARXIV_CACHE_EXPIRY even in a long running process
+@coalesce
+@arxiv_cache.memoize(expire=ARXIV_CACHE_EXPIRY)
 def fetch_arxiv_by_id(arxiv_id):
 
     # Search for the paper using the Arxiv API
@@ -98,36 +257,43 @@ def fetch_arxiv_by_id(arxiv_id):
 ################################################################################
 # Function to convert dense vector to binary vector
 def dense_to_binary(dense_vector):
-    return np.packbits(np.where(dense_vector >= 0, 1, 0)).tobytes()
+    # packbits takes the boolean mask directly, no integer temporary needed
+    return np.packbits(dense_vector >= 0).tobytes()
 
-# Function to embed text
-@cache
-def embed(text):
+# Function to convert a batch of dense vectors to binary vectors, packing all rows in one pass
+def dense_to_binary_batch(dense_vectors):
+    return [packed.tobytes() for packed in np.packbits(dense_vectors >= 0, axis=1)]
+
+# Function to embed a batch of texts in a single model call or API request
+def embed_batch(texts):
 
     # Check if the embedding should be a float or binary vector
-    if FLOAT:
+    if EMBED_FLOAT:
 
         # Check if the embedding should be generated locally or using the MixedBread.ai API
         if LOCAL:
 
-            # Calculate embeddings by calling model.encode(), specifying the device
-            embedding = model.encode(text, device=device, precision="float32")
+            # Calculate unit length embeddings by calling model.encode(), specifying the device
+            with torch.inference_mode():
+                embeddings = model.encode(texts, device=device, precision="float32", normalize_embeddings=True)
 
-            # Enforce 32-bit float precision
-            embedding = np.array(embedding, dtype=np.float32)
+            # Enforce 32-bit float precision, without copying if already float32
+            embeddings = [np.asarray(embedding, dtype=np.float32) for embedding in embeddings]
         
         else:
-            # Call the MixedBread.ai API to generate the embedding
+            # Call the MixedBread.ai API to generate the embeddings
             result = mxbai.embeddings(
                 model='mixedbread-ai/mxbai-embed-large-v1',
-                input=text,
+                input=texts,
                 normalized=True,
                 encoding_format='float',
                 truncation_strategy='end',
-                dimensions=1024
+                dimensions=EMBED_DIM
             )
 
-            embedding = np.array(result.data[0].embedding, dtype=np.float32)
+            # Results carry their input position, restore the input order
+            # Build float32 arrays directly from the lists, skipping the float64 default
+            embeddings = [np.fromiter(item.embedding, dtype=np.float32, count=EMBED_DIM) for item in sorted(result.data, key=lambda item: item.index)]
     
     # If the embedding should be a binary vector
     else:
@@ -136,113 +302,301 @@ def embed(text):
         if LOCAL:
 
             # Calculate embeddings by calling model.encode(), specifying the device
-            embedding = model.encode(text, device=device, precision="float32")
+            with torch.inference_mode():
+                embeddings = model.encode(texts, device=device, precision="float32")
 
             # Enforce 32-bit float precision
-            embedding = np.array(embedding, dtype=np.float32)
+            embeddings = np.asarray(embeddings, dtype=np.float32)
 
-            # Convert the dense vector to a binary vector
-            embedding = dense_to_binary(embedding)
+            # Convert the dense vectors to binary vectors
+            embeddings = dense_to_binary_batch(embeddings)
         
         else:
 
-            # Call the MixedBread.ai API to generate the embedding
+            # Call the MixedBread.ai API to generate the embeddings
             result = mxbai.embeddings(
                 model='mixedbread-ai/mxbai-embed-large-v1',
-                input=text,
+                input=texts,
                 normalized=True,
                 encoding_format='ubinary',
                 truncation_strategy='end',
-                dimensions=1024
+                dimensions=EMBED_DIM
             )
 
-            # Convert the embedding to a numpy array of uint8 encoding and then to bytes
-            embedding = np.array(result.data[0].embedding, dtype=np.uint8).tobytes()
+            # The ubinary values are in [0, 255], but the SDK parses them as floats, so cast them to uint8 before taking the bytes
+            embeddings = [np.array(item.embedding, dtype=np.uint8).tobytes() for item in sorted(result.data, key=lambda item: item.index)]
+
+    return embeddings
+
+################################################################################
+# Class to coalesce concurrent embedding requests into a single batched call
+class EmbeddingBatcher:
+
+    def __init__(self, embed_fn, max_batch_size=64, max_wait=0.01):
+
+        # Function that embeds a list of texts
+        self.embed_fn = embed_fn
+
+        # Max. number of texts to send in one call
+        self.max_batch_size = max_batch_size
+
+        # Time in seconds to wait for more requests before flushing a batch
+        self.max_wait = max_wait
+
+        # Queue of pending (text, future) pairs
+        self.pending = queue.Queue()
+
+        # Flush batches from a background thread
+        threading.Thread(target=self.worker, daemon=True).start()
+
+    # Function to queue a text, returns a future that resolves to its embedding
+    def submit(self, text):
+
+        future = Future()
+        self.pending.put((text, future))
+
+        return future
+
+    # Function to collect pending requests and embed them in one call
+    def worker(self):
+
+        while True:
+
+            # Block until at least one request arrives
+            batch = [self.pending.get()]
+
+            # Gather whatever else arrives within the coalescing window
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+
+                try:
+                    batch.append(self.pending.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            try:
+
+                # Embed the whole batch at once
+                embeddings = self.embed_fn([text for text, _ in batch])
+
+                # A short response would leave some callers waiting forever, fail them all instead
+                if len(embeddings) != len(batch):
+                    raise ValueError(f"Expected {len(batch)} embeddings, got {len(embeddings)}")
+
+            except Exception as e:
+
+                # Propagate the failure to every waiting caller
+                for _, future in batch:
+                    future.set_exception(e)
+
+                continue
+
+            # Hand each caller its own embedding
+            for (_, future), embedding in zip(batch, embeddings):
+                future.set_result(embedding)
+
+# Shared batcher for all incoming requests
+embedding_batcher = EmbeddingBatcher(embed_batch)
+
+# Function to embed text through the batcher
+# Retries back off on the caller's thread and resubmit, so a failing batch never stalls the batcher's worker
+@retry_with_backoff()
+def embed_batched(text):
+    return embedding_batcher.submit(text).result()
+
+# Function to embed text
+@lru_cache(maxsize=8192)
+def embed(text):
+
+    # Key the on-disk cache by a hash of model and text, long abstracts make poor keys
+    key = hashlib.sha256(f"{model_name}:{text}".encode()).hexdigest()
+
+    # Check the on-disk cache before calling the model
+    embedding = embed_cache.get(key)
+
+    if embedding is None:
+
+        # Wait for the embedding, computed together with any concurrent requests
+        embedding = embed_batched(text)
+
+        embed_cache.set(key, embedding)
 
     return embedding
 
 ################################################################################
 # Single vector search
+# pymilvus already retries unavailable and rate limited RPCs, retrying again here would multiply the attempts
+def search(vector, limit, with_vector=False):
+
+    # Tune the HNSW beam width to the number of results, ef must be at least limit
+    if FLOAT:
+        search_params = {"params": {"ef": max(HNSW_EF, limit*4)}}
 
-def search(vector, limit):
+    # Number of BIN_IVF_FLAT clusters to scan for binary vectors
+    else:
+        search_params = {"params": {"nprobe": BIN_IVF_NPROBE}}
 
     result = milvus_client.search(
         collection_name="arxiv_abstracts", # Collection to search in
         data=[vector], # Vector to search for
         limit=limit, # Max. number of search results to return
-        output_fields=['id', 'vector', 'title', 'abstract', 'authors', 'categories', 'month', 'year', 'url'] # Output fields to return
+        search_params=search_params, # Index specific search parameters
+        output_fields=['title', 'abstract', 'authors', 'month', 'year', 'url'] + (['vector'] if with_vector else []) # Only the fields shown on the result cards, and the vector if asked for
     )
 
     # returns a list of dictionaries with id and distance as keys
     return result[0]
 
+# Function to search binary vectors with a float query, oversample the candidates and rescore them
+def rescored_search(query_vector, limit):
+
+    # Search the binary index for more candidates than needed, along with their binary vectors
+    candidates = search(dense_to_binary(query_vector), limit*RESCORE_OVERSAMPLE, with_vector=True)
+
+    if not candidates:
+        return candidates
+
+    # Unpack the candidate bits into a (candidates, EMBED_DIM) matrix of 0s and 1s
+    candidate_bits = np.frombuffer(b"".join([vector_from_row(candidate['entity']) for candidate in candidates]), dtype=np.uint8)
+    candidate_bits = np.unpackbits(candidate_bits.reshape(len(candidates), -1), axis=1)
+
+    # Score every candidate against the float query in one matrix-vector product
+    scores = candidate_bits @ query_vector
+
+    # Keep the best scoring candidates
+    return [candidates[i] for i in np.argsort(-scores)[:limit]]
+
 ################################################################################
-# Function to fetch paper details of all results
-def fetch_all_details(search_results):
+# Function to get the vector out of a Milvus row
+def vector_from_row(row):
+
+    # Get the 1024-dimensional dense vector
+    if FLOAT:
+        return row['vector']
+
+    # Get the bytes of a binary vector
+    return row['vector'][0]
+
+# Function to fetch the stored vector of a paper, raises KeyError if it is not in the database
+# lru_cache doesn't cache exceptions, so only hits are kept and papers added by the daily ingest are found on the next query
+@lru_cache(maxsize=4096)
+def fetch_stored_vector(arxiv_id):
+
+    # Popular papers are prefetched at startup
+    if arxiv_id in popular_vectors:
+        return popular_vectors[arxiv_id]
+
+    # Only fetch the vector, the other fields are not needed to search
+    id_in_db = milvus_client.get(collection_name="arxiv_abstracts", ids=[arxiv_id], output_fields=['vector'])
+
+    # If the id is not in database
+    if not id_in_db:
+        raise KeyError(arxiv_id)
+
+    return vector_from_row(id_in_db[0])
+
+# Function to fetch the stored vector of a paper, returns None if it is not in the database
+def fetch_vector_by_id(arxiv_id):
 
-    # Initialize an empty string to store the cards
-    cards = ""
+    try:
+        return fetch_stored_vector(arxiv_id)
+
+    except KeyError:
+        return None
+
+################################################################################
+# Warm up Milvus
+
+# Set once the collection has been loaded into memory
+collection_loaded = threading.Event()
+
+# Queries stop waiting for the load at this point, so a hanging load costs the timeout once, not once per query
+collection_load_deadline = time.monotonic() + COLLECTION_LOAD_TIMEOUT
+
+# Vectors of popular papers, keyed by arXiv ID
+popular_vectors = {}
+
+# Function to fetch the vectors of popular papers in one batched request
+def prefetch_popular_vectors():
+
+    # The list of popular IDs is optional
+    if not os.path.exists(POPULAR_IDS_FILE):
+        return
+
+    with open(POPULAR_IDS_FILE) as f:
+        popular_ids = f.read().split()
+
+    if not popular_ids:
+        return
 
-    for search_result in search_results:
+    rows = milvus_client.get(collection_name="arxiv_abstracts", ids=popular_ids, output_fields=['vector'])
 
-        paper_details = search_result['entity']
+    popular_vectors.update({row['id']: vector_from_row(row) for row in rows})
 
-    # chr(10) is a new line character, replace to avoid formatting issues
-        card = f"""
-## [{paper_details['title']}]({paper_details['url']})
-> **{paper_details['authors']}** | _{paper_details['month']} {paper_details['year']}_ \n
-{paper_details['abstract']}
+# Function to load the collection ahead of the first query
+def warm_up_milvus():
+
+    try:
+        milvus_client.load_collection(collection_name="arxiv_abstracts", timeout=COLLECTION_LOAD_TIMEOUT)
+
+        # Run a throwaway search to page in the index before the first real query
+        probe_vector = [1.0] + [0.0] * (EMBED_DIM - 1) if FLOAT else bytes(EMBED_DIM // 8)
+        milvus_client.search(collection_name="arxiv_abstracts", data=[probe_vector], limit=1, timeout=COLLECTION_LOAD_TIMEOUT)
+
+    finally:
+        # Don't keep queries waiting on a failed or timed out load, it surfaces on the first search instead
+        collection_loaded.set()
+
+    # Queries may start now, popular papers are served from memory once this is done
+    prefetch_popular_vectors()
+
+# Load in the background so the app starts serving right away
+threading.Thread(target=warm_up_milvus, daemon=True).start()
+
+################################################################################
+# Template of a result card, built once and filled in for every search result
+card_template = """
+## [{title}]({url})
+> **{authors}** | _{month} {year}_ \n
+{abstract}
 ***
 """
-    
-        cards +=card
-    
-    return cards
 
-################################################################################
+# Function to fetch paper details of all results
+def fetch_all_details(search_results):
 
-# Function to handle the UI logic
-def predict(input_text, limit=5, increment=5):
+    # Fill in a card per paper and join them once
+    return "".join([card_template.format_map(search_result['entity']) for search_result in search_results])
 
-    # Check if input is empty
-    if input_text == "":
-        raise gr.Error("Please provide either an ArXiv ID or an abstract.", 10)
-    
-    # Define extra outputs to pass
-    # This hack shows the load_more button once the search has been made
-    show_element = gr.update(visible=True)
+################################################################################
+
+# Function to find papers similar to an arXiv ID or an abstract
+# Identical concurrent searches share a single run
+@coalesce
+def find_similar_papers(input_text, limit):
 
-    # This variable is used to increment the search limit when the load_more button is clicked
-    new_limit = limit+increment
-    
     # Extract arxiv id, if any
     arxiv_id = extract_arxiv_id(input_text)
 
     # When arxiv id is found in input text 
     if arxiv_id:
 
-        # Search if id is already in database
-        id_in_db = milvus_client.get(collection_name="arxiv_abstracts",ids=[arxiv_id])
+        # Look up the stored vector, if the id is already in database
+        abstract_vector = fetch_vector_by_id(arxiv_id)
 
-        # If the id is already in database
-        if bool(id_in_db):
+        # If the id is already in database, search with its stored vector
+        if abstract_vector is not None:
+            return fetch_all_details(search(abstract_vector, limit))
 
-            # Get the 1024-dimensional dense vector
-            if FLOAT:
-                abstract_vector = id_in_db[0]['vector']
-
-            # Get the bytes of a binary vector
-            else:
-                abstract_vector = id_in_db[0]['vector'][0] 
-
-        # If the id is not already in database
-        else:
+        # Search arxiv for paper details
+        arxiv_json = fetch_arxiv_by_id(arxiv_id)
 
-            # Search arxiv for paper details
-            arxiv_json = fetch_arxiv_by_id(arxiv_id)
-
-            # Embed abstract
-            abstract_vector = embed(arxiv_json['abstract'])
+        # Embed abstract
+        abstract_vector = embed(arxiv_json['abstract'])
     
     # When arxiv id is not found in input text, treat input text as abstract
     else:
@@ -250,11 +604,42 @@ def predict(input_text, limit=5, increment=5):
         # Embed abstract
         abstract_vector = embed(input_text)
 
-    # Search database
-    search_results = search(abstract_vector, limit)
+    # Search database, rescoring binary results with the float embedding if enabled
+    if EMBED_FLOAT and not FLOAT:
+        search_results = rescored_search(abstract_vector, limit)
+
+    else:
+        search_results = search(abstract_vector, limit)
 
     # Gather details about the found papers
-    all_details = fetch_all_details(search_results)
+    return fetch_all_details(search_results)
+
+# Function to handle the UI logic
+def predict(input_text, limit=5, increment=5):
+
+    # Collapse whitespace so reformatted pastes hit the same cache entries, and drop text the model would truncate anyway
+    input_text = " ".join(input_text.split())[:MAX_INPUT_CHARS]
+
+    # Check if input is empty
+    if input_text == "":
+        raise gr.Error("Please provide either an ArXiv ID or an abstract.", 10)
+
+    # Never search for more results than the server allows
+    limit = max(1, min(int(limit), MAX_LIMIT))
+
+    # Wait for the collection to be loaded before the first search
+    # Only wait until the startup deadline, afterwards search right away and let Milvus surface any error
+    collection_loaded.wait(timeout=max(0, collection_load_deadline - time.monotonic()))
+    
+    # Define extra outputs to pass
+    # This hack shows the load_more button once the search has been made, until the max. limit is reached
+    show_element = gr.update(visible=limit < MAX_LIMIT)
+
+    # This variable is used to increment the search limit when the load_more button is clicked
+    new_limit = limit+increment
+
+    # Find the related papers
+    all_details = find_similar_papers(input_text, limit)
         
     return all_details, show_element, new_limit
 
@@ -274,8 +659,17 @@ examples = [
     "Smart TV and privacy"
 ]
 
-# Show total number of entries in database
-num_entries = format(milvus_client.get_collection_stats(collection_name="arxiv_abstracts")['row_count'], ",")
+# Function to show the total number of entries in database, looked up on page load instead of at import
+def update_placeholder():
+
+    try:
+        num_entries = format(milvus_client.get_collection_stats(collection_name="arxiv_abstracts")['row_count'], ",")
+
+    # Keep the generic placeholder if Milvus isn't reachable
+    except Exception:
+        return gr.update()
+
+    return gr.update(placeholder=f"Search {num_entries} papers on arXiv")
 
 # Create a back to top button
 back_to_top_btn_html = '''
@@ -320,7 +714,7 @@ with gr.Blocks(theme=gr.themes.Soft(font=gr.themes.GoogleFont("Helvetica"),
     # Input Section
     with gr.Row():
         input_text = gr.Textbox(
-            placeholder=f"Search {num_entries} papers on arXiv",
+            placeholder="Search papers on arXiv",
             autofocus=True,
             submit_btn=True,
             show_label=False
@@ -342,10 +736,11 @@ with gr.Blocks(theme=gr.themes.Soft(font=gr.themes.GoogleFont("Helvetica"),
     load_more_button = gr.Button("More results ⬇️", visible=False)
 
     # Event handler for the input text box, triggers the search function
-    input_text.submit(predict, [input_text, page_limit, increment], [output, load_more_button, new_page_limit])
+    # Searches and "Load More" clicks share one pool of workers
+    input_text.submit(predict, [input_text, page_limit, increment], [output, load_more_button, new_page_limit], concurrency_limit=CONCURRENCY_LIMIT, concurrency_id="predict")
 
     # Event handler for the "Load More" button
-    load_more_button.click(predict, [input_text, new_page_limit, increment], [output, load_more_button, new_page_limit])
+    load_more_button.click(predict, [input_text, new_page_limit, increment], [output, load_more_button, new_page_limit], concurrency_limit=CONCURRENCY_LIMIT, concurrency_id="predict")
 
     # Example inputs
     gr.Examples(
@@ -363,8 +758,14 @@ with gr.Blocks(theme=gr.themes.Soft(font=gr.themes.GoogleFont("Helvetica"),
     # Attribution
     gr.HTML(contact_text)
 
+    # Fill in the number of papers once the page is loaded
+    demo.load(update_placeholder, outputs=input_text)
+
 ################################################################################
 
 if __name__ == "__main__":
     
+    # Handle several searches at once, they mostly wait on Milvus and the embedding API
+    demo.queue(default_concurrency_limit=CONCURRENCY_LIMIT, max_size=MAX_QUEUE_SIZE)
+
     demo.launch(ssr_mode=False, server_port=7860, node_port=7861, favicon_path='logo.png', show_api=False)
\ No newline at end of file